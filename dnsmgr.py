@@ -19,10 +19,8 @@ the configuration file
 import os
 import sys
 import ipaddress
+import concurrent.futures
 import logging
-import yaml
-
-from orderedattrdict import AttrDict
 
 import dnsmgr_util as util
 
@@ -34,6 +32,7 @@ class Zones:
         self.reverse4 = []
         self.reverse6 = []
         
+        self.forward = {}       # key is zonename, value is zone
         self.lpm4 = None
         self.lpm6 = None
 
@@ -47,9 +46,12 @@ class Zones:
 
     def init_search(self):
         """
+        Sort the forward zones on zonename length
         Sort the IPv4 and IPv6 prefixes and create a data structure for
         fast longest prefix match
         """
+        self.zones.sort(key=lambda x: len(x.zone))
+
         self.lpm4 = util.Mtrie4()
         self.lpm6 = util.Mtrie6()
         
@@ -68,12 +70,11 @@ class Zones:
     def add_zone(self, zone):
         """
         Forward zones
-        Keep sorted on longest zonename
+        Sorted on zonename length in init_search()
         """
         a = util.Zone(zone, typ="forward")
-        tmp = self.zones + [a]
-        tmp.sort(key=lambda x: len(x.zone))
-        self.zones = tmp
+        self.zones.append(a)
+        self.forward[zone] = a
 
     def add_zone_reverse4(self, zonename):
         """
@@ -92,11 +93,7 @@ class Zones:
         prefixlen = 8 * len(tmp)
         
         # Reverse the addresses
-        prefix = []
-        for t in tmp:
-            prefix.insert(0, t)
-        while len(prefix) != 4:
-            prefix.append("0")
+        prefix = tmp[::-1] + ["0"] * (4 - len(tmp))
 
         prefixstr = ".".join(prefix)
         prefixstr += "/%s" % prefixlen
@@ -122,17 +119,9 @@ class Zones:
         prefixlen = 4 * len(tmp)
         
         # Reverse the addresses
-        prefix = []
-        for t in tmp:
-            prefix.insert(0, t)
-        while len(prefix) != 32:
-            prefix.append("0")
+        prefix = tmp[::-1] + ["0"] * (32 - len(tmp))
         
-        prefixstr = ""
-        for ix in range(0, len(prefix)):
-            if ix and (ix % 4) == 0:
-                prefixstr += ":"
-            prefixstr += prefix[ix]
+        prefixstr = ":".join(["".join(prefix[ix:ix + 4]) for ix in range(0, 32, 4)])
         prefixstr += "/%s" % prefixlen
         prefix = ipaddress.IPv6Network(prefixstr, strict=True)
         log.debug("prefix %s", prefix)
@@ -146,15 +135,14 @@ class Zones:
     #
     
     def add_rr(self, rr):
-        # search for a matching zone
-        for zone in self.zones:
-            if zone.zone == rr.domain:
-                zone.add_rr(rr)
-                return
-        log.info("Ignored, NOT handling forward DNS for %s", rr)
+        zone = self.forward.get(rr.domain)
+        if zone is not None:
+            zone.add_rr(rr)
+        else:
+            log.info("Ignored, NOT handling forward DNS for %s", rr)
 
     def add_rr_reverse4(self, rr):
-        zone = self.lpm4.lookup(str(rr.name))
+        zone = self.lpm4.lookup(rr.name)
         if zone is not None:
             zone.add_rr(rr)
         else:
@@ -243,37 +231,47 @@ class DNS_Mgr:
         self.zones.init_search()
 
         # Go through all records, and add them to the correct zone
+        RR = util.RR
+        addr_to_str = util.addr_to_str
+        add_rr = self.zones.add_rr
+        add_rr_reverse4 = self.zones.add_rr_reverse4
+        add_rr_reverse6 = self.zones.add_rr_reverse6
         for record in records:
             if record.typ == "A":
                 for value in record.value:
                     # forward
-                    rr = util.RR(domain=record.domain, ttl=record.ttl, name=record.name, typ=record.typ, value=value)
-                    self.zones.add_rr(rr)
+                    add_rr(RR(domain=record.domain, ttl=record.ttl, name=record.name, typ=record.typ, value=addr_to_str(value)))
                     
                     # reverse
                     if record.reverse:
-                        rr = util.RR(domain=record.domain, ttl=record.ttl,name=value, typ="PTR", value=record.name)
-                        self.zones.add_rr_reverse4(rr)
+                        add_rr_reverse4(RR(domain=record.domain, ttl=record.ttl, name=value, typ="PTR", value=record.name))
                     
             elif record.typ == "AAAA":
                 for value in record.value:
                     # forward
-                    rr = util.RR(domain=record.domain, ttl=record.ttl,name=record.name, typ=record.typ, value=value)
-                    self.zones.add_rr(rr)
+                    add_rr(RR(domain=record.domain, ttl=record.ttl, name=record.name, typ=record.typ, value=addr_to_str(value)))
                     
                     # reverse
                     if record.reverse:
-                        rr = util.RR(domain=record.domain, ttl=record.ttl, name=value, typ="PTR", value=record.name)
-                        self.zones.add_rr_reverse6(rr)
+                        add_rr_reverse6(RR(domain=record.domain, ttl=record.ttl, name=value, typ="PTR", value=record.name))
                     
             else:
                 for value in record.value:
-                    rr = util.RR(domain=record.domain, ttl=record.ttl, name=record.name, typ=record.typ, value=value)
-                    self.zones.add_rr(rr)
+                    add_rr(RR(domain=record.domain, ttl=record.ttl, name=record.name, typ=record.typ, value=value))
                 
-        # Write the files to the backend
-        for zone in self.zones:
-            self.driver.saveZone(zone)
+        # Write the files to the backend, zones are independent of each
+        # other and saving is mostly waiting on I/O, so save in parallel
+        try:
+            workers = self.config.dns_server.workers
+        except AttributeError:
+            workers = 4     # default
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(self.driver.saveZone, self.zones))
+        finally:
+            # remember what was saved, also if some zone failed
+            if hasattr(self.driver, "saveDigests"):
+                self.driver.saveDigests()
 
     def update_dhcp(self):
         """
@@ -339,7 +337,7 @@ class CLI_load(BaseCLI):
         for record in self.mgr.records:
             for value in record.value:
                 tmp = "%s.%s" % (record.name, record.domain)
-                print("%-30s %5s %-8s %s" % (tmp, record.ttl, record.typ, value))
+                print("%-30s %5s %-8s %s" % (tmp, record.ttl, record.typ, util.value_to_str(value)))
                 print("        reverse=%s" % (record.reverse), end="")
                 if record.mac_address:
                     print("  mac=%s" % (record.mac_address), end="")
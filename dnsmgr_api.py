@@ -5,12 +5,15 @@ A standalone HTTP server, implementing a REST API
 '''
 
 import os
+import hmac
 import base64
+import socket
 import ipaddress
 import json
+import threading
+import socketserver
 import http.server
 
-from orderedattrdict import AttrDict
 import dnsmgr_util as util
 
 from dnsmgr import DNS_Mgr
@@ -18,6 +21,7 @@ from dnsmgr import DNS_Mgr
 auth_handler = None
 config = None
 mgr = DNS_Mgr()
+mgr_lock = threading.Lock()     # serialize requests that use mgr
 
 
 class Auth:
@@ -28,18 +32,33 @@ class Auth:
         self.valid_prefixes = None
         if valid_prefixes:
             self.valid_prefixes = []
+            self.lpm4 = util.Mtrie4()
+            self.lpm6 = util.Mtrie6()
             for prefix in valid_prefixes:
-                self.valid_prefixes.append(ipaddress.ip_network(prefix))
+                prefix = ipaddress.ip_network(prefix)
+                self.valid_prefixes.append(prefix)
+                if prefix.version == 4:
+                    self.lpm4.add_prefix(prefix, True)
+                else:
+                    # Mtrie6 works on nibbles, split prefix into nibble aligned ones
+                    prefixlen = (prefix.prefixlen + 3) // 4 * 4
+                    for subnet in prefix.subnets(new_prefix=prefixlen):
+                        self.lpm6.add_prefix(subnet, True)
     
     def auth(self, request):
         if self.valid_prefixes is None:
             return False
         
         # Check if the request is from an allowed prefix
-        addr = ipaddress.ip_network(request.client_address[0])
-        for prefix in self.valid_prefixes:
-            if prefix.overlaps(addr):
+        addr = request.client_address[0]
+        try:
+            if ":" in addr:
+                if self.lpm6.lookup(socket.inet_pton(socket.AF_INET6, addr)):
+                    return False
+            elif self.lpm4.lookup(socket.inet_pton(socket.AF_INET, addr)):
                 return False
+        except OSError:
+            pass    # not an address we can match, reject
         
         # Don't return any response, just closing connection
         return True
@@ -55,6 +74,7 @@ class Basic_Auth(Auth):
         self.username = username
         self.password = password
         self.key = base64.b64encode(bytes('%s:%s' % (username, password), 'utf-8')).decode('ascii')
+        self.auth_header = ('Basic ' + self.key).encode('ascii')
     
     def send_authhead(self, request):
         request.send_response(401)
@@ -71,7 +91,7 @@ class Basic_Auth(Auth):
             response = { 'errno' : 1, 'errmsg': 'No auth header received'}
             request.wfile.write(json.dumps(response).encode())
             return True
-        if auth_header == 'Basic ' + self.key:
+        if hmac.compare_digest(auth_header.encode('utf-8'), self.auth_header):
             return False    # Auth is correct
         
         self.send_authhead(request)
@@ -92,30 +112,35 @@ class Dnsmgr_RequestHandler(http.server.BaseHTTPRequestHandler):
         response_code = 200
         p = self.path
         if p == "/get_zones":
-            data = mgr.getZones()
+            with mgr_lock:
+                data = mgr.getZones()
             message = { 'errno': 0, 'errmsg': '', 'data': data }
             
         elif p == "/restart":
-            mgr.restart()
+            with mgr_lock:
+                mgr.restart()
             message = { 'errno': 0, 'errmsg': '' }
 
         elif p == "/status":
             message = { 'errno': 1, 'errmsg': 'Not implemented' }
         
         elif p == "/update_dns":
-            mgr.load()
-            mgr.update_dns()
+            with mgr_lock:
+                mgr.load()
+                mgr.update_dns()
             message = { 'errno': 0, 'errmsg': '' }
         
         elif p == "/update_dhcp":
-            mgr.load()
-            mgr.update_dhcp()
+            with mgr_lock:
+                mgr.load()
+                mgr.update_dhcp()
             message = { 'errno': 0, 'errmsg': '' }
         
         elif p == "/update":
-            mgr.load()
-            mgr.update_dns()
-            mgr.update_dhcp()
+            with mgr_lock:
+                mgr.load()
+                mgr.update_dns()
+                mgr.update_dhcp()
             message = { 'errno': 0, 'errmsg': '' }
 
         else:
@@ -155,7 +180,7 @@ class Dnsmgr_RequestHandler(http.server.BaseHTTPRequestHandler):
                     print("Writing new records to %s" % target.name)
                     content_len = int(self.headers['content-length'])
                     data = self.rfile.read(content_len).decode()
-                    with open(target.name, "w") as outfile:
+                    with mgr_lock, open(target.name, "w") as outfile:
                         outfile.write(data)
                         outfile.write('\n')
                     message = { 'errno': 0, 'errmsg': '' }
@@ -174,6 +199,14 @@ class Dnsmgr_RequestHandler(http.server.BaseHTTPRequestHandler):
         self.wfile.write(bytes(message, "utf8"))
 
         
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Handle each request in its own thread, so a long update does not
+    block other requests
+    """
+    daemon_threads = True
+
+
 def main():
     global auth_handler, config
     
@@ -194,7 +227,7 @@ def main():
         util.die("Error: Unknown auth type %s" % config.auth)
 
     server_address = (config.address, config.port)
-    httpd = http.server.HTTPServer(server_address, Dnsmgr_RequestHandler)
+    httpd = ThreadingHTTPServer(server_address, Dnsmgr_RequestHandler)
 
     print("Starting server")
     httpd.serve_forever()
@@ -17,31 +17,37 @@ Note:
      anders ALL=(root) NOPASSWD: /usr/sbin/service bind9 restart
 '''
 
+import os
+import re
+import json
+import binascii
+import shutil
+import hashlib
+import threading
 import subprocess
+import concurrent.futures
 import datetime
-import ipaddress
 
 from orderedattrdict import AttrDict
 
 import dnsmgr_util as util
 
-def ipv4_addr_to_reverse(addr):
+def ipv4_addr_to_reverse(addr, skip=0):
     """
-    Returns the string in reverse, dot as delemiter
+    Returns the packed IPv4 address in reverse, dot as delemiter
     1.2.3.4 returns 4.3.2.1
+    skip is number of leading octets to leave out, 1.2.3.4 with skip=2 returns 4.3
     """
-    ip = addr.split(".")
-    return ".".join(reversed(ip))
+    return ".".join([str(i) for i in reversed(addr[skip:])])
 
 
-def ipv6_addr_to_reverse(addr):
+def ipv6_addr_to_reverse(addr, skip=0):
     """
-    Returns the IPv6 address, expanded and a dot between each hex digit
+    Returns the packed IPv6 address, expanded and a dot between each hex digit
     2001:db8::1 returns 1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.8.b.d.0.1.0.0.2
+    skip is number of leading nibbles to leave out
     """
-    addr = ipaddress.IPv6Address(addr)
-    ip = addr.exploded.replace(":", "")
-    return ".".join(reversed(ip))
+    return ".".join(reversed(binascii.hexlify(addr)[skip:].decode()))
 
 
 class NS_Exception(Exception):
@@ -60,29 +66,25 @@ class ParserException(Exception):
     pass
 
 
+whitespace_re = re.compile(r"[ \n\t]*")
+tokenchars_re = re.compile(r"[a-zA-Z]*")
+
+# max number of named.conf include files read in parallel from a remote server
+include_workers = 8
+
+# line in zonefile with the SOA serial number, ends with "; Serial"
+serial_re = re.compile(rb"^[^\n]*; serial[ \t\r\f\v]*$", re.IGNORECASE | re.MULTILINE)
+
+
 class Parser:
     """
     Parser, for bind configuration files
+    The whole file is read into memory, and scanned using regexps
     """
     def __init__(self, f):
-        self.f = f
-        self.stack = ""
-        self.tokenchars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
-
-    def getNextChar(self):
-        """Returns None at end of file"""
-        if self.stack:
-            c = self.stack[-1]
-            self.stack = self.stack[:-1]
-            return c
-        c = self.f.read(1)
-        if c:
-            return c
-        return None
-
-    def ungetChar(self, c):
-        self.stack += c
-    
+        self.buf = f.read()
+        self.pos = 0
+
     def getToken(self):
         """
         Return next token
@@ -90,51 +92,35 @@ class Parser:
         Skip comments
         If quoted, continue to next quote and return string
         """
-        token = ""
+        buf = self.buf
+        end = len(buf)
         while True:
-            c = self.getNextChar()
-            if c is None:
-                return c
-            while c and c in " \n\t":
-                c = self.getNextChar()
+            if self.pos >= end:
+                return None
+            pos = whitespace_re.match(buf, self.pos).end()
+            if pos >= end:
+                # only whitespace left
+                self.pos = pos
+                return ""
+            c = buf[pos]
 
             if c == '"':
                 # string, parse to next quote
-                while True:
-                    c = self.getNextChar()
-                    if c == '"' or c is None:
-                        return token
-                    token += c
-                    
-            if c == ';' or c == '#':
+                p = buf.find('"', pos + 1)
+                if p < 0:
+                    self.pos = end
+                    return buf[pos + 1:]
+                self.pos = p + 1
+                return buf[pos + 1:p]
+
+            if c == ';' or c == '#' or buf.startswith("//", pos):
                 # comment, ignore rest of line
-                while c and c != '\n':
-                    c = self.getNextChar()
+                p = buf.find('\n', pos)
+                self.pos = end if p < 0 else p + 1
                 continue
 
-            if c == '/':
-                c2 = self.getNextChar()
-                if c2 == '/':
-                    # comment. ignore rest of line
-                    while c2 and c2 != '\n':
-                        c2 = self.getNextChar()
-                    continue
-                self.ungetChar(c2)
- 
-            if c is not None:
-                token += c
-            c = self.getNextChar()
-            while c and c in self.tokenchars:
-                token += c
-                c = self.getNextChar()
-            if c:
-                self.ungetChar(c)
-            return token
-                
-        # end of file, return what we have
-        if token:
-            return token
-        return None
+            self.pos = tokenchars_re.match(buf, pos + 1).end()
+            return buf[pos:self.pos]
 
     def requireToken(self, req):
         """
@@ -155,6 +141,7 @@ class FileMgr:
         self.proc = None    # subprocess being run
         self.f = None       # file handle to read/write, for subprocess
         self.filename = filename
+        self.checksum = None    # sha256 of the file, if known
         if filename and openFile:
             self.open(filename, mode)
         
@@ -165,11 +152,7 @@ class FileMgr:
             raise FileNotFoundError("Unknown file mode %s" % mode)
         
         if self.remote:
-            cmd = ["ssh"]
-            if self.remote.port:
-                cmd.append("-p")
-                cmd.append(self.remote.port)
-            cmd.append(self.remote.host)
+            cmd = ["ssh"] + util.ssh_options(self.remote) + [self.remote.host]
             if mode == "r":
                 cmd += ["cat", filename]
                 self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1)
@@ -242,21 +225,17 @@ class FileMgr:
             raise ValueError("Can't copy source->dest if both are remote files, not implemented")
         
         elif self.remote:
-            cmd = ["scp"]
-            if self.remote.port:
-                cmd += ["-P", self.remote.port]
+            cmd = ["scp"] + util.ssh_options(self.remote, "-P")
             cmd += ["%s:%s" % (self.remote.host, self.filename), dest.filename]
             return util.runCmd(cmd=cmd)
 
         elif dest.remote:
-            cmd = ["scp"]
-            if dest.remote.port:
-                cmd += ["-P", dest.remote.port]
+            cmd = ["scp"] + util.ssh_options(dest.remote, "-P")
             cmd += [self.filename, "%s:%s" % (dest.remote.host, dest.filename)]
             return util.runCmd(cmd=cmd)
 
-        cmd = ["cp", "--force", self.filename, dest.filename]
-        return util.runCmd(cmd=cmd)
+        # both local, copy without starting a process
+        shutil.copyfile(self.filename, dest.filename)
                 
             
     def move(self, dest):
@@ -277,10 +256,15 @@ class FileMgr:
         return ret
         
     def sha256sum(self):
-        """Calculate sha256 checksum on file"""
-        cmd = ["sha256sum", self.filename]
-        out = util.runCmd(self.remote, cmd)
-        return out.split()[0].decode()
+        """
+        Calculate sha256 checksum on file
+        The checksum is remembered, set checksum to None if the file is changed
+        """
+        if self.checksum is None:
+            cmd = ["sha256sum", self.filename]
+            out = util.runCmd(self.remote, cmd)
+            self.checksum = out.split()[0].decode()
+        return self.checksum
 
     def compare(self, dest):
         """
@@ -323,6 +307,8 @@ class NS_Manager:
             self.remote = None
             
         self.zones = {}
+        self.digests = None     # sha256 of saved include files, key is destination
+        self.digests_lock = threading.Lock()
     
     def _verifyTmpDir(self, remote=None):
         """
@@ -331,6 +317,50 @@ class NS_Manager:
         fdir = FileMgr(remote=remote, filename=self.tmpdir, mode="w", openFile=False)
         fdir.mkdir()
         
+    def _digestKey(self, filename):
+        """
+        Returns key in digests for a file, includes the host so
+        configurations sharing tmpdir don't mix up their files
+        """
+        if self.remote:
+            return "%s:%s:%s" % (self.remote.host, self.remote.port, filename)
+        return ":%s" % filename
+
+    def _getDigest(self, filename):
+        """
+        Returns sha256 of the include file, as saved by an earlier run
+        """
+        with self.digests_lock:
+            if self.digests is None:
+                try:
+                    with open("%s/digests.json" % self.tmpdir) as f:
+                        self.digests = json.load(f)
+                except (OSError, ValueError):
+                    self.digests = {}
+            return self.digests.get(self._digestKey(filename))
+
+    def _setDigest(self, filename, digest):
+        """
+        Remember sha256 of a saved include file, for the next run
+        Written to disk by saveDigests()
+        """
+        with self.digests_lock:
+            self.digests[self._digestKey(filename)] = digest
+
+    def saveDigests(self):
+        """
+        Write the sha256 of all saved include files to tmpdir
+        Call once, after all zones are saved
+        """
+        with self.digests_lock:
+            if self.digests is None:
+                return
+            self._verifyTmpDir()
+            filename = "%s/digests.json" % self.tmpdir
+            with open(filename + ".tmp", "w") as f:
+                json.dump(self.digests, f)
+            os.replace(filename + ".tmp", filename)
+
 
     def restart(self):
         """
@@ -362,8 +392,8 @@ class NS_Manager:
         tmpfile = "%s/%s" % (self.tmpdir, zoneinfo.name)
 
         # Copy file to temp
-        fsrc = FileMgr(self.remote, zoneinfo.file)
-        fdst = FileMgr(filename=tmpfile, mode="w")
+        fsrc = FileMgr(self.remote, zoneinfo.file, openFile=False)
+        fdst = FileMgr(filename=tmpfile, openFile=False)
         fsrc.copy(fdst)
 
         # compare checksums on original and copied file
@@ -371,21 +401,16 @@ class NS_Manager:
             raise NS_Exception("Error, copied file differs in checksum")
         
         # We now have a verified copy of the file locally, Search for serial number
-        f = open(tmpfile)
-        fpos = f.tell()
-        line = f.readline()
-        serial = None
-        while line:
-            line = line.rstrip()
-            if line.lower().endswith("; serial"):
-                serial = line
-                serialfpos = fpos
-            fpos = f.tell()
-            line = f.readline()
-        f.close()
-        
-        if serial is None:
+        with open(tmpfile, "rb") as f:
+            data = f.read()
+        m = None
+        for m in serial_re.finditer(data):
+            pass    # use the last matching line
+        if m is None:
             raise NS_Exception("Can't find serial number in file %s" % zoneinfo.file)
+        # latin-1, so position in string is same as position in file
+        serial = m.group().rstrip().decode("latin-1")
+        serialfpos = m.start()
         
         # search backwards for first digit
         p = len(serial) - len("; Serial")
@@ -431,8 +456,8 @@ class NS_Manager:
         # Copy the file with updated serial number to server
         if self.remote:
             self._verifyTmpDir(self.remote)
-            fsrc = FileMgr(filename=tmpfile)
-            fdst = FileMgr(self.remote, tmpfile, mode="w")
+            fsrc = FileMgr(filename=tmpfile, openFile=False)
+            fdst = FileMgr(self.remote, tmpfile, openFile=False)
             fsrc.copy(fdst)
         
             # Compare checksums on local and remote file so copy was ok
@@ -441,8 +466,8 @@ class NS_Manager:
             
         # Verify size between original file and file with updated serial
         # They should be identical, since serial number never changes size
-        fsrc = FileMgr(remote=self.remote, filename=tmpfile)
-        fdst = FileMgr(remote=self.remote, filename=zoneinfo.file)
+        fsrc = FileMgr(remote=self.remote, filename=tmpfile, openFile=False)
+        fdst = FileMgr(remote=self.remote, filename=zoneinfo.file, openFile=False)
         if fsrc.size() != fdst.size():
             raise NS_Exception("Error: Old file and new file has different sizes")
              
@@ -486,91 +511,117 @@ class NS_Manager:
                     
             return zone
         
-        def parseBindConfigFile(filename):
+        def openParser(filename):
+            f = FileMgr(self.remote)
+            f.open(filename, "r")
+            return Parser(f)
+
+        def parseBindConfigFile(parser):
             """
             Recursive function, to handle INLINE statement
+            Included files on a remote server are read in parallel, then
+            parsed in order
             """
-            f = FileMgr(self.remote)
-            f.open(filename, "r")
-            parser = Parser(f)
+            items = []      # include filenames and zones, in file order
+            includes = []
             token = "dummy"
             while token is not None:
                 token = parser.getToken()
                 if token == 'include':
                     filename = parser.getToken()
-                    parseBindConfigFile(filename)
+                    items.append(filename)
+                    includes.append(filename)
                     
                 elif token == 'zone':
-                    zone = parseZone(parser)
-                    if zone.name not in self.ignorezones:
-                        self.zones[zone.name] = zone
-
-        parseBindConfigFile(filename)
+                    items.append(parseZone(parser))
+
+            parsers = {}
+            if includes and self.remote:
+                # each read is a round trip to the server, do them in parallel
+                workers = min(len(includes), include_workers)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    parsers = dict(zip(includes, executor.map(openParser, includes)))
+
+            for item in items:
+                if isinstance(item, ZoneInfo):
+                    if item.name not in self.ignorezones:
+                        self.zones[item.name] = item
+                elif item in parsers:
+                    parseBindConfigFile(parsers[item])
+                else:
+                    parseBindConfigFile(openParser(item))
+
+        parseBindConfigFile(openParser(filename))
         return self.zones
 
     def saveZone(self, zone):
         """
         Save zone resource records
-        We always write to a temp file, then comparing the new file with the
-        original. If they differ we replace the original file, increase the 
-        SOA serial number and reload the zone
+        If the content is the same as when the include file was last saved,
+        nothing is done. Otherwise we write to a temp file, then comparing
+        the new file with the original. If they differ we replace the
+        original file, increase the SOA serial number and reload the zone
+        Remove digests.json in tmpdir to force a compare of all files
         """
         zoneinfo = self.zones[zone.zonefile]
         
         # Create name of zonefile
         zonefile = self.includefile.format(zone=zone.zonefile)
 
-        self._verifyTmpDir()
-        filename = "%s/%s" % (self.tmpdir, zonefile)
-        f = open(filename, "w")
-        f.write(";\n")
-        f.write("; File generated by DnsNgr\n")
-        f.write("; Do not edit, changes will be overwritten\n")
-        f.write(";\n")
-        f.write("; Zonefile : %s/%s\n" % (self.includedir, zonefile))
-        f.write("; Records  : %d\n" % len(zone))
-        f.write(";\n\n")
-        f.write("$ORIGIN %s.\n\n" % zone.zone)
+        lines = [
+            ";\n",
+            "; File generated by DnsNgr\n",
+            "; Do not edit, changes will be overwritten\n",
+            ";\n",
+            "; Zonefile : %s/%s\n" % (self.includedir, zonefile),
+            "; Records  : %d\n" % len(zone),
+            ";\n\n",
+            "$ORIGIN %s.\n\n" % zone.zone,
+        ]
         
         if zone.typ == "forward":
-            for rrlist in zone:
-                for rr in rrlist.__iter__():
-                    f.write("%-30s  %5s  %-8s    %s\n" % (rr.name, rr.ttl, rr.typ, rr.value))
+            lines += ["%-30s  %5s  %-8s    %s\n" % (rr.name, rr.ttl, rr.typ, rr.value)
+                      for rrlist in zone for rr in rrlist]
             
         elif zone.typ == "reverse4":
-            st = -len(zone.zone) - 1
-            for rrlist in zone.__iter__():
-                for rr in rrlist:
-                    name = ipv4_addr_to_reverse(str(rr.name)) + ".in-addr.arpa"
-                    name = name[:st]
-                    f.write("%-30s  %5s  %s    %s.%s.\n" % (name, rr.ttl, rr.typ, rr.value, rr.domain))
-        
+            # names are relative to the zone, leave out the octets in the zone name
+            skip = zone.prefix.prefixlen // 8
+            lines += ["%-30s  %5s  %s    %s.%s.\n" % \
+                      (ipv4_addr_to_reverse(rr.name, skip), rr.ttl, rr.typ, rr.value, rr.domain)
+                      for rrlist in zone for rr in rrlist]
         
         elif zone.typ == "reverse6":
-            st = -len(zone.zone) - 1
-            for rrlist in zone.__iter__():
-                for rr in rrlist:
-                    name = ipv6_addr_to_reverse(rr.name) + ".ip6.arpa"
-                    name = name[:st]
-                    f.write("%-50s  %5s  %s    %s.%s.\n" % (name, rr.ttl, rr.typ, rr.value, rr.domain))
+            # names are relative to the zone, leave out the nibbles in the zone name
+            skip = zone.prefix.prefixlen // 4
+            lines += ["%-50s  %5s  %s    %s.%s.\n" % \
+                      (ipv6_addr_to_reverse(rr.name, skip), rr.ttl, rr.typ, rr.value, rr.domain)
+                      for rrlist in zone for rr in rrlist]
 
         else:
-            print("Error: zone %s, unknown zone type %s" % (zone.name, zone.typ))
+            print("Error: zone %s, unknown zone type %s" % (zone.zone, zone.typ))
         
-        f.close()
+        content = "".join(lines).encode()
+        digest = hashlib.sha256(content).hexdigest()
+        fdst = FileMgr(remote=self.remote, filename="%s/%s" %\
+                       (self.includedir, zonefile), openFile=False)
+        if digest == self._getDigest(fdst.filename) and fdst.exist():
+            log.debug("Zone %s unchanged since last save", zone.zone)
+            return
+
+        self._verifyTmpDir()
+        filename = "%s/%s" % (self.tmpdir, zonefile)
+        with open(filename, "wb") as f:
+            f.write(content)
+        fsrc = FileMgr(filename=filename, openFile=False)
+        fsrc.checksum = digest
         
         if self.remote:
-            fsrc = FileMgr(filename=filename)
-            fdst = FileMgr(remote=self.remote, filename=filename)
-            fsrc.copy(fdst)
+            ftmp = FileMgr(remote=self.remote, filename=filename, openFile=False)
+            fsrc.copy(ftmp)
             
-            if not fsrc.compare(fdst):
+            if not fsrc.compare(ftmp):
                 raise NS_Exception("Error: Copied file has incorrect checksum, copy failed")
-
-
-        fsrc = FileMgr(remote=self.remote, filename=filename)
-        fdst = FileMgr(remote=self.remote, filename="%s/%s" %\
-                       (self.includedir, zonefile), openFile=False)
+            fsrc = ftmp     # checksum now known to be digest
 
         if fdst.exist():
             replace = not fsrc.compare(fdst)
@@ -578,9 +629,13 @@ class NS_Manager:
             replace = True
        
         if replace:
-            fsrc.move(fdst)
+            if fsrc.move(fdst) != 0:
+                raise NS_Exception("Error: Can't move %s to %s" % (fsrc.filename, fdst.filename))
             self.increaseSoaSerial(zoneinfo)
 
+        # include file now has the new content, remember it for next run
+        self._setDigest(fdst.filename, digest)
+
     
 def main():
     import argparse
@@ -11,7 +11,6 @@ import os
 import sys
 import ipaddress
 import logging
-import yaml
 
 from orderedattrdict import AttrDict
 
@@ -66,7 +65,7 @@ class DHCPd_manager:
                     name = record.fqdn.replace(".", "_")
                     ipv4_file.write("host %s {\n" % name)
                     ipv4_file.write("  hardware ethernet %s;\n" % record.mac_address)
-                    ipv4_file.write("  fixed-address %s;\n" % record.value[0])
+                    ipv4_file.write("  fixed-address %s;\n" % util.addr_to_str(record.value[0]))
                     ipv4_file.write("}\n")
                     
             elif v6_enabled and record.typ == "AAAA":
@@ -75,7 +74,7 @@ class DHCPd_manager:
                     name = record.fqdn.replace(".", "_")
                     ipv6_file.write("host %s {\n" % name)
                     ipv6_file.write("  hardware ethernet %s;\n" % record.mac_address)
-                    ipv6_file.write("  fixed-address6 %s;\n" % record.value[0])
+                    ipv6_file.write("  fixed-address6 %s;\n" % util.addr_to_str(record.value[0]))
                     ipv6_file.write("}\n")
 
         if v4_enabled:
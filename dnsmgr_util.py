@@ -5,9 +5,10 @@ Common utilities
 
 import os
 import sys
+import array
+import socket
 import ipaddress
 import logging
-import pprint
 import yaml
 import importlib.machinery
 import builtins
@@ -17,10 +18,17 @@ import logging.handlers
 
 from orderedattrdict import AttrDict
 
-pp = pprint.PrettyPrinter(indent=4)
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader     # PyYAML built without libyaml
+
 
 allowed_chars = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_-."
 
+# translate() table that deletes all allowed characters
+allowed_chars_table = str.maketrans("", "", allowed_chars)
+
 
 def die(msg, exitcode=1):
     print(msg)
@@ -112,11 +120,59 @@ def now_str():
     return now().strftime("%Y%m%d%H%M%S")
 
 
+# All ssh/scp sessions to a host share one connection, through a socket in
+# this directory. It must not be writable by other users, or they could
+# put their own socket there, see ControlPath in ssh_config(5)
+ssh_control_dir = "~/.ssh"
+_ssh_control_path = False   # not checked yet
+
+
+def ssh_control_path():
+    """
+    Returns the ControlPath for ssh/scp
+    Returns None if ssh_control_dir can't be created, or is writable
+    by other users, then connections are not shared
+    """
+    global _ssh_control_path
+    if _ssh_control_path is not False:
+        return _ssh_control_path
+    path = os.path.expanduser(ssh_control_dir)
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.stat(path)
+    except OSError as err:
+        log.warning("Not sharing ssh connections, can't create %s: %s", path, err)
+        _ssh_control_path = None
+        return None
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        log.warning("Not sharing ssh connections, %s is writable by other users", path)
+        _ssh_control_path = None
+        return None
+    _ssh_control_path = os.path.join(path, "dnsmgr-%C")
+    return _ssh_control_path
+
+
+def ssh_options(remote, port_option="-p"):
+    """
+    Returns the options for ssh/scp to remote
+    The first session starts a master connection, following sessions
+    reuse it. The master is kept open for a while after last use
+    port_option is "-p" for ssh and "-P" for scp
+    """
+    opts = []
+    control_path = ssh_control_path()
+    if control_path:
+        opts += ["-o", "ControlMaster=auto",
+                 "-o", "ControlPath=%s" % control_path,
+                 "-o", "ControlPersist=60"]
+    if remote.port:
+        opts += [port_option, str(remote.port)]
+    return opts
+
+
 def runCmd(remote=None, cmd=None, call=False):
     if remote:
-        if remote.port:
-            cmd = ["-p", remote.port] + cmd
-        cmd = ["ssh", remote.host] + cmd
+        cmd = ["ssh"] + ssh_options(remote) + [remote.host] + cmd
     if call:
         return subprocess.call(cmd, timeout=10)
     return subprocess.check_output(cmd, timeout=10)
@@ -216,7 +272,7 @@ def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=AttrDict):
 def yaml_load(filename):
     with open(filename, "r") as f:
         try:
-            data = ordered_load(f, yaml.SafeLoader)
+            data = ordered_load(f, SafeLoader)
             return data
         except yaml.YAMLError as err:
             raise UtilException("Cannot load YAML file %s, err: %s" % (filename, err))
@@ -224,63 +280,87 @@ def yaml_load(filename):
 
 def verify_dnsname(name):
     """Check if a name contains valid characters"""
-    for n in name:
-        if n not in allowed_chars:
-            return False
-    return True
+    return not name.translate(allowed_chars_table)
+
+
+def addr_to_str(addr):
+    """
+    Convert a packed IPv4 or IPv6 address to string
+    """
+    if len(addr) == 4:
+        return socket.inet_ntop(socket.AF_INET, addr)
+    return socket.inet_ntop(socket.AF_INET6, addr)
+
+
+def value_to_str(value):
+    """
+    Convert a record value to string, packed addresses are
+    converted to their text form
+    """
+    if isinstance(value, bytes):
+        return addr_to_str(value)
+    return str(value)
 
 
 class RR:
     """
     One Resource Record
     """
+    __slots__ = ("domain", "ttl", "name", "typ", "value", "obj")
+
     def __init__(self, domain=None, ttl="", name=None, typ=None, value=None, obj=None):
         self.domain = domain
         self.ttl = ttl
         self.name = name
-        self.fqdn = "%s.%s" % (self.name, self.domain)
-        self.typ = typ.upper()
+        self.typ = sys.intern(typ.upper())
         self.value = value
         self.obj = obj
 
+    @property
+    def fqdn(self):
+        """
+        Created when needed, drivers normally only use name and domain
+        """
+        return "%s.%s" % (value_to_str(self.name), self.domain)
+
     def __str__(self):
         return "domain=%s, name=%s, typ=%s, value=%s obj=%s" % \
-            (self.domain, self.name, self.typ, self.value, self.obj)
+            (self.domain, value_to_str(self.name), self.typ, value_to_str(self.value), self.obj)
 
 
 class Record:
     """
     Represents one record with type and values
+    value is one value, more values are added with add_value()
     """
+    __slots__ = ("domain", "ttl", "name", "typ", "value", "fqdn", "mac_address", "forward", "reverse")
+
     def __init__(self, domain=None, ttl="", name=None, typ=None, value=None, mac_address=None,
                 forward=None, reverse=None):
         self.domain = domain
         self.ttl = ttl
         self.name = name
         self.typ = typ
-        if isinstance(value, list):
-            self.value = value
-        else:
-            self.value = [value]
-        self.fqdn = "%s.%s" % (name, domain)
+        self.value = [value]
+        self.fqdn = sys.intern("%s.%s" % (name, domain))
         self.mac_address = mac_address      # For writing DHCP config
         self.forward = forward
         self.reverse = reverse
     
     def __str__(self):
-        return "Record(domain=%s, ttl=%s, name=%s, typ=%s, value=%s, mac_address=%s, forward=%s, reverse=%s)" %\
-            (self.domain, self.ttl, self.name, self.typ, self.value, self.mac_address, self.forward, self.reverse)
+        return "Record(domain=%s, ttl=%s, name=%s, typ=%s, value=[%s], mac_address=%s, forward=%s, reverse=%s)" %\
+            (self.domain, self.ttl, self.name, self.typ, self.value_as_str(), self.mac_address, self.forward, self.reverse)
     
     def add_value(self, value):
-        if isinstance(value, list):
-            self.value += value
-        else:
-            self.value.append(value)
+        self.value.append(value)
+
+    def add_values(self, values):
+        self.value.extend(values)
         
     def value_as_str(self):
         res = []
         for value in self.value:
-            res.append(str(value))
+            res.append(value_to_str(value))
         return ", ".join(res)
 
 
@@ -289,24 +369,36 @@ class Records:
     Manage a list of records
     """    
     def __init__(self):
-        self._records = {}    # key is name+typ
+        self._records = {}    # key is (fqdn, typ)
+        self._sorted_keys = None    # cached sorted keys, None if changed
+        self._last_key = None       # key and record of the last add()
+        self._last_record = None
         self.domain = None
     
     def __len__(self):
         return len(self._records)
 
     def add(self, record):
-        key = record.fqdn + chr(0) + record.typ
-        if key in self._records:
+        key = (record.fqdn, record.typ)
+        if key == self._last_key:
+            # Same name and type as previous record, common in sorted files
+            self._last_record.add_values(record.value)
+            return
+        existing = self._records.get(key)
+        if existing is not None:
             # Record exist, add additional value to it
-            self._records[key].add_value(record.value)
+            existing.add_values(record.value)
+            record = existing
         else:
             self._records[key] = record
+            self._sorted_keys = None
+        self._last_key = key
+        self._last_record = record
 
     def __iter__(self):
-        keys = list(self._records.keys())
-        keys.sort()
-        for key in keys:
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self._records)
+        for key in self._sorted_keys:
             yield self._records[key]
             
     def items(self):
@@ -320,57 +412,67 @@ class Mtrie4:
     """
     Implements Longest Prefix Match, for IPv4 addresses
     Uses a mtrie with 8-8-8-8 distribution
-    
+
+    The nodes are stored in flat arrays, each node is a block of 256 slots,
+    one slot for each value of the octet. child[] holds the offset of the
+    next level node (0 if none, the root is never a child) and obj[] holds
+    the object for the prefix ending at this level
+
     Note, there are no functionality to remove prefixes
     Note, add prefixes in correct order, start with all /32 down to /1
     """
-    
-    class Node:
-        def __init__(self):
-            self.child = {}
-            self.obj = {}
-        
-        def __repr__(self):
-            return "Node(%s, %s)" % (self.child, self.obj)
-   
+
     def __init__(self):
-        self.root = self.Node()
-    
+        self.child = array.array("l", bytes(256 * array.array("l").itemsize))
+        self.obj = [None] * 256
+
+    def _add_node(self):
+        """
+        Allocate a new node, returns its offset
+        """
+        offset = len(self.obj)
+        self.child.extend(array.array("l", bytes(256 * self.child.itemsize)))
+        self.obj.extend([None] * 256)
+        return offset
+
     def add_prefix(self, prefix, obj):
-        p = self.root
-        ip = str(prefix[0]).split(".")
+        addr = int(prefix.network_address)
         l = prefix.prefixlen
+        shift = 24
+        pos = 0
 
         while l > 8:
-            i = int(ip.pop(0))
-            if i not in p.child:
-                p.child[i] = self.Node()
-            p = p.child[i]
+            ix = pos + ((addr >> shift) & 0xff)
+            if not self.child[ix]:
+                self.child[ix] = self._add_node()
+            pos = self.child[ix]
+            shift -= 8
             l -= 8
-        
-        i = int(ip.pop(0))
-        b = i
-        e = i + (128 >> l)
-        for ix in range(b, e + 1):
-            if ix not in p.obj:
-                p.obj[ix] = obj
+
+        # fill the slots, keep slots already set by longer prefixes
+        b = pos + ((addr >> shift) & 0xff)
+        e = b + (1 << (8 - l))
+        self.obj[b:e] = [obj if o is None else o for o in self.obj[b:e]]
 
     def lookup(self, addr):
         """
         Search using LPM
+        addr is a packed IPv4 address
         Returns obj if found
         If not found, returns None
         """
-        p = self.root
-        ip = addr.split(".")
+        child = self.child
+        obj = self.obj
         found = None
-        while True:
-            i = int(ip.pop(0))
-            if i in p.obj:
-                found = p.obj[i]
-            if i not in p.child:
-                return found
-            p = p.child[i]
+        pos = 0
+        for i in addr:
+            ix = pos + i
+            if obj[ix] is not None:
+                found = obj[ix]
+            pos = child[ix]
+            if not pos:
+                break
+        return found
 
 
 class Mtrie6:
@@ -380,9 +482,12 @@ class Mtrie6:
     Note, there are no functionality to remove prefixes
     """
     class Node:
+        """
+        One slot per nibble value, None if not set
+        """
         def __init__(self):
-            self.child = {}
-            self.obj = {}
+            self.child = [None] * 16
+            self.obj = [None] * 16
         
         def __repr__(self):
             return "Node(%s, %s)" % (self.child, self.obj)
@@ -393,46 +498,45 @@ class Mtrie6:
     
     def add_prefix(self, prefix, obj):
         p = self.root
-        ip = prefix.exploded.replace(":", "")
+        addr = int(prefix.network_address)
         l = prefix.prefixlen
         if l % 4 != 0:
             raise ValueError("Cannot handle IPv6 prefixes on non-nibbles")
+        shift = 124
 
         while l > 4:
-            i = int(ip[0], 16)
-            ip = ip[1:]
-            if i not in p.child:
+            i = (addr >> shift) & 0xf
+            if p.child[i] is None:
                 p.child[i] = self.Node()
             p = p.child[i]
+            shift -= 4
             l -= 4
         
-        i = int(ip[0])
-        ip = ip[1:]
-        b = i
-        e = i + (128 >> l)
-        for ix in range(b, e + 1):
-            if ix not in p.obj:
-                p.obj[ix] = obj
+        # fill the slots, keep slots already set by longer prefixes
+        b = (addr >> shift) & 0xf
+        e = b + (1 << (4 - l))
+        p.obj[b:e] = [obj if o is None else o for o in p.obj[b:e]]
 
 
     def lookup(self, addr):
         """
         Search using LPM
+        addr is a packed IPv6 address
         Returns obj if found
         If not found, returns None
         """
-        addr = ipaddress.IPv6Address(addr)
+        addr = int.from_bytes(addr, "big")
         p = self.root
-        ip = addr.exploded.replace(":", "")
+        shift = 124
         found = None
         while True:
-            i = int(ip[0], 16)
-            ip = ip[1:]
-            if i in p.obj:
+            i = (addr >> shift) & 0xf
+            if p.obj[i] is not None:
                 found = p.obj[i]
-            if i not in p.child:
-                return found
             p = p.child[i]
+            if p is None:
+                return found
+            shift -= 4
         
 
 class Zone:
@@ -447,6 +551,7 @@ class Zone:
             self.zonefile = zone
         
         self.records = {}
+        self._sorted_keys = None    # cached sorted keys, None if changed
         self.l = len(self.zone)
 
     def __str__(self):
@@ -460,17 +565,18 @@ class Zone:
         return len(self.records)
 
     def __iter__(self):
-        keys = list(self.records.keys())
-        keys.sort()
-        for key in keys:
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self.records)
+        for key in self._sorted_keys:
             yield self.records[key]
 
     def add_rr(self, rr):
-        key = str(rr.name) + rr.domain
+        key = (rr.name, rr.domain)
         if key in self.records:
             self.records[key].append(rr)
         else:
             self.records[key] = [rr]
+            self._sorted_keys = None
 
 
 class Zones:
@@ -600,7 +706,7 @@ class Zones:
         log.info("Ignored, NOT handling forward DNS for %s", rr)
 
     def add_rr_reverse4(self, rr):
-        zone = self.lpm4.lookup(str(rr.name))
+        zone = self.lpm4.lookup(rr.name)
         if zone is not None:
             zone.add_rr(rr)
         else:
@@ -4,13 +4,17 @@ Load resource records from a text file.
 '''
 
 import os
+import re
 import sys
-import ipaddress
+import socket
 
 import dnsmgr_util as util
 
 allowed_chars = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_-."
 
+# [whitespace] <name> [ttl] <type> <value>, name is @ or only allowed_chars
+record_re = re.compile(r"\s*(@|[0-9a-zA-Z_.\-]+)\s+(?:([0-9]+)\s+)?(\S+)\s+(.*\S)")
+
 
 class Loader:
     """
@@ -21,12 +25,22 @@ class Loader:
         self.forward = True
         self.reverse4 = True
         self.reverse6 = True
+        self._including = set()     # files being read, to detect $INCLUDE loops
 
     def _get_boolean(self, value):
         value = value.lower()
         if value.lower() not in ['on', 'off', 'true', 'false', '1', '0', 't', 'f', 'yes', 'no']:
             raise ValueError('Invalid value %s, should be ON or OFF' % tmp[1])
         return value in ['on', 'true', '1', 't', 'yes']
+
+    def _get_address(self, family, value, line):
+        """
+        Returns the address as packed bytes
+        """
+        try:
+            return socket.inet_pton(family, value)
+        except OSError:
+            raise ValueError("Invalid address: %s in %s" % (value, line))
         
     def load(self, filename=None, records=None):
         """
@@ -34,15 +48,40 @@ class Loader:
         
         filename: file to read
         records:  where to store loaded records
+        """
+        for record in self.iter_load(filename):
+            records.add(record)
+
+    def iter_load(self, filename):
+        """
+        Read the records file, yield each record as it is parsed
         
         Empty lines and comments starting with # or ; is ignored
 
         recursive function, to handle $INCLUDE to other files
         """
-        self.domain = os.path.basename(filename)
-        for line in open(filename, "r"):
+        path = os.path.realpath(filename)
+        if path in self._including:
+            raise ValueError("$INCLUDE loop, %s is already being read" % filename)
+        self.domain = sys.intern(os.path.basename(filename))
+        with open(filename, "r") as f:
+            lines = f.read().splitlines()
+        self._including.add(path)
+        try:
+            yield from self._parse_lines(lines)
+        finally:
+            self._including.discard(path)
+
+    def _parse_lines(self, lines):
+        """
+        Parse the lines from one records file, yield each record
+        """
+        match = record_re.match
+        get_address = self._get_address
+        intern = sys.intern
+        for line in lines:
             line = line.rstrip()
-            if line == "" or line[0] == "#" or line[0] == ";":
+            if not line or line.startswith(("#", ";")):
                 continue
             if line[0] == "$":
                 tmp = line.split(None, 2)
@@ -50,10 +89,10 @@ class Loader:
                     raise ValueError("Invalid $ syntax: %s" % line)
 
                 elif tmp[0] == "$DOMAIN":
-                    self.domain = tmp[1]
+                    self.domain = sys.intern(tmp[1])
 
                 elif tmp[0] == "$INCLUDE":
-                    self.load(filename=tmp[1])
+                    yield from self.iter_load(tmp[1])
 
                 elif tmp[0] == "$FORWARD":
                     self.forward = self._get_boolean(tmp[1])
@@ -86,24 +125,23 @@ class Loader:
                     elif key == 'reverse':
                         reverse = self._get_boolean(val)
     
-            tmp = line.split(None, 3)
-            if len(tmp) < 2:
+            m = match(line)
+            if m is None:
+                tmp = line.split(None, 1)
+                if len(tmp) == 2 and tmp[0] != "@" and not util.verify_dnsname(tmp[0]):
+                    raise ValueError("Invalid name: %s in %s" % (tmp[0], line))
                 raise ValueError("Invalid syntax: %s" % line)
-            
-            name = tmp.pop(0)
-            if name != "@" and not util.verify_dnsname(name):
-                raise ValueError("Invalid name: %s in %s" % (name, line))
 
-            if tmp[0].isdigit():
-                ttl = tmp.pop(0)
-            else:
+            name, ttl, typ, value = m.groups()
+            if ttl is None:
                 ttl = ""
-            typ = tmp.pop(0).upper()
-            value = tmp.pop(0)
+            else:
+                ttl = intern(ttl)
+            typ = intern(typ.upper())
             if typ == "A":
-                value = ipaddress.IPv4Address(value)
+                value = get_address(socket.AF_INET, value, line)
             elif typ == "AAAA":
-                value = ipaddress.IPv6Address(value)
+                value = get_address(socket.AF_INET6, value, line)
             elif typ not in ["CNAME", "MX", "NS", "PTR", "SRV", "SSHFP", "TLSA", "TSIG", "TXT"]:
                 raise ValueError("Invalid type: %s in %s" % (typ, line))
             
@@ -121,7 +159,7 @@ class Loader:
                                  mac_address=mac_address,
                                  reverse=reverse,
                                  )
-            records.add(record)
+            yield record
 
 
 def main():